@@ -1,17 +1,25 @@
 """
 pandas-based data storage and manipulation system
-stores and reads data to and from a csv file
+stores and reads data to and from a csv or a parquet file
 """
 
+import functools
+import numpy as np
+import operator
 import os
 import pandas as pd
 
 
 class DataStorage:
-    EXT = ".csv"   #storage file extension
+    EXT = ".csv"   #storage file extension (of csv storages, and of the legacy csv files of storages that are moved to another format)
+    EXTENSIONS = {"csv": EXT, "parquet": ".parquet"}   #storage file extension of each storage format
 
+    #comparison operators supported by the row filtering methods (for numpy arrays and for pandas series)
+    _OPS = {"gt": np.greater, "lt": np.less, "eq": np.equal, "neq": np.not_equal}
+    _SERIES_OPS = {"gt": operator.gt, "lt": operator.lt, "eq": operator.eq, "neq": operator.ne}
 
-    def __init__(self, file_name, base_dir, columns = None, column_types = None):
+
+    def __init__(self, file_name, base_dir, columns = None, column_types = None, storage_format = "csv"):
         """
         initialize a DataStorage object
         initializes the data storage name (file_name without "_" and capitalized first letter)
@@ -23,17 +31,30 @@ class DataStorage:
             - if not None, a header-less data storage file is saved (not required to save column names to the file if they are forced when the data storage is initialized)
             - if None and no dataframe is loaded (with read_data), integer column names will be created when using add_rows
             - if None and a dataframe is loaded (with read_data) from a file that has no column names, the first row from the file will be considered as the column names
-        column_types: data type for each column. used when reading the storage file
+        column_types: data type for each column (dictionary of column names and types). used when reading the storage file to skip type inference
+        storage_format: format of the storage file (csv or parquet)
+            - parquet files store the column names, column types and index, and are much faster to read and write than csv files
+            - if a parquet storage file does not exist but a legacy csv file (with the same name) does, the csv file is read and converted to parquet
         """
 
         self._name = " ".join([word.capitalize() for word in file_name.split("_")]) #capitalize first letters and remove "_"
-        self.file_path = os.path.join(base_dir, file_name + DataStorage.EXT)
+        self.storage_format = storage_format
+        self.file_path = os.path.join(base_dir, file_name + DataStorage.EXTENSIONS[storage_format])
+        self._legacy_file_path = os.path.join(base_dir, file_name + DataStorage.EXT) #csv file of storages created before they were moved to another format
 
         self.columns = columns
         self.column_types = column_types
 
         self.df = pd.DataFrame(columns = columns)
 
+        #rows added with add_rows are buffered here and only concatenated to self.df on flush()
+        self._pending_rows = []
+        self._pending_indices = []
+        self._pending_ignore_index = True
+
+        #format of the dates index. the index is kept as a datetime index in memory and only converted to strings (with this format) when saving
+        self._date_format = None
+
     def get_name(self):
         """
         get the name of the data storage (file_name with no "_" and capitalized first letters)
@@ -44,33 +65,73 @@ class DataStorage:
         return self._name
 
 
-    def read_data(self, header = 0, index_col = False):
+    def read_data(self, header = 0, index_col = False, chunksize = None, date_format = None):
         """
         read the db file and add the required columns
 
-        header: row number to use for column names. this parameter is ignored if self.columns is not None
-        index_col: column number (integer) or name (string) to use as the index
+        header: row number to use for column names. this parameter is ignored if self.columns is not None or if the storage format is parquet
+        index_col: column number (integer) or name (string) to use as the index. for parquet files, only a name can be used and only if the index was not saved with the file
+        chunksize: if not None, the file is read in chunks of this number of rows (lowers peak memory when reading large files). this parameter is ignored if the storage format is parquet
+        date_format: if not None, the index is parsed to a datetime index using this format (and saved back with it in save_data)
         return: True if file exists and opened, False otherwise
         """
 
-        if not os.path.isfile(self.file_path):
+        file_path = self.file_path
+        storage_format = self.storage_format
+
+        #storages moved to another format may still have their data in a legacy csv file. read it in this case (it is converted to the storage format below)
+        if not os.path.isfile(file_path) and storage_format != "csv" and os.path.isfile(self._legacy_file_path):
+            file_path = self._legacy_file_path
+            storage_format = "csv"
+
+        if not os.path.isfile(file_path):
             return False
 
-        if self.columns is not None:
-            self.df = pd.read_csv(self.file_path, names = self.columns, dtype = self.column_types, index_col = index_col)
+        self._clear_pending_rows()
+
+        if storage_format == "parquet":
+            #column names, column types and the index are stored in parquet files
+            df = pd.read_parquet(file_path, columns = self.columns)
+
+            if isinstance(index_col, str) and index_col in df.columns:
+                df.set_index(index_col, inplace = True)
+
+            #column types are already stored in the file. astype only converts the columns with different types
+            if self.column_types is not None:
+                df = df.astype({column: column_type for column, column_type in self.column_types.items() if column in df.columns}, copy = False)
         else:
-            self.df = pd.read_csv(self.file_path, header = header, index_col = index_col)
+            if self.columns is not None:
+                df = pd.read_csv(file_path, names = self.columns, dtype = self.column_types, index_col = index_col, chunksize = chunksize)
+            else:
+                df = pd.read_csv(file_path, header = header, index_col = index_col, dtype = self.column_types, engine = "c", chunksize = chunksize)
+
+            #when reading in chunks, read_csv returns an iterator of dataframes. concatenate them once
+            if chunksize is not None:
+                df = pd.concat(list(df), copy = False)
+
+        if date_format is not None:
+            df.index = DataStorage._parse_dates(df.index, date_format)
+            self._date_format = date_format
+
+        self.df = df
+
+        #convert a legacy csv file to the storage format (the csv file is kept)
+        if file_path != self.file_path:
+            self.save_data(save_index = index_col is not False)
 
         return True
 
     def save_data(self, save_index = False, file_path = None):
         """
         save the data frame to a file without the column names row or index column
+        parquet files always store the column names
 
         save_index: if True, index labels are saved
         file_path: complete file path (directory + file name + extension) to use instead of self.file_path
         """
 
+        self.flush()
+
         if file_path is None:
             file_path = self.file_path
 
@@ -79,11 +140,23 @@ class DataStorage:
         if not os.path.exists(storage_dir):
             os.makedirs(storage_dir)
 
+        if self.storage_format == "parquet":
+            #dates are stored natively in parquet files, so a dates index is saved as is
+            self.df.to_parquet(file_path, index = save_index, compression = "zstd")
+            return
+
+        #convert a dates index to strings on a shallow copy (the data itself is not copied)
+        df_to_save = self.df
+
+        if self._date_format is not None and isinstance(self.df.index, pd.DatetimeIndex):
+            df_to_save = self.df.copy(deep = False)
+            df_to_save.index = df_to_save.index.strftime(self._date_format)
+
         #if self.column is not None, no column names are saved since the function assumes that column names are hard-coded
         if self.columns is not None:
-            self.df.to_csv(file_path, index = save_index, header = False)
+            df_to_save.to_csv(file_path, index = save_index, header = False)
         else:
-            self.df.to_csv(file_path, index = save_index, header = True)
+            df_to_save.to_csv(file_path, index = save_index, header = True)
 
 
     def set_dataframe(self, df, columns = None, column_types = None):
@@ -98,6 +171,7 @@ class DataStorage:
         self.columns = columns
         self.column_types = column_types
 
+        self._clear_pending_rows()
         self.df = df
 
     def index_to_column(self, inplace = True):
@@ -105,11 +179,19 @@ class DataStorage:
         convert the dataframe index to a column
         does not modify self.columns
 
-        inplace: if False, a new dataframe is created (and returned) without modifying the original one
+        inplace: if False, a new dataframe is created (and returned) without modifying the original one. the new dataframe shares buffers with self.df, so changes to its data affect this data storage
         return: None if inplace = True, a new dataframe with the index converted to a column if inplace = False
         """
 
-        df = self.df.reset_index(inplace = inplace)
+        self.flush()
+
+        if inplace:
+            self.df.reset_index(inplace = True)
+            return None
+
+        #reset_index copies all the data when inplace = False. resetting a shallow copy in place avoids most of this copying
+        df = self.df.copy(deep = False)
+        df.reset_index(inplace = True)
         return df
 
     def column_to_index(self, column_name, inplace = True):
@@ -119,11 +201,19 @@ class DataStorage:
         old index is removed
 
         column_name: column name to set as the index
-        inplace: if False, a new dataframe is created (and returned) without modifying the original one
+        inplace: if False, a new dataframe is created (and returned) without modifying the original one. the new dataframe shares buffers with self.df, so changes to its data affect this data storage
         return: None if inplace = True, a new dataframe with the index converted to a column if inplace = False
         """
 
-        df = self.df.set_index(column_name, inplace = inplace)
+        self.flush()
+
+        if inplace:
+            self.df.set_index(column_name, inplace = True)
+            return None
+
+        #set_index copies all the data when inplace = False. setting the index of a shallow copy in place avoids most of this copying (the block holding column_name may still be copied)
+        df = self.df.copy(deep = False)
+        df.set_index(column_name, inplace = True)
         return df
 
 
@@ -136,28 +226,62 @@ class DataStorage:
         default_value: value to use in the added column for all rows available
         """
 
+        self.flush()
+
         self.df[column_name] = default_value
 
     def add_rows(self, rows, indices = None):
         """
         append rows to the data frame
+        rows are buffered and only concatenated to the data frame on flush() (called by all methods that use the data frame)
 
         rows: list of lists of the values for each column of the data frame
         indices: list of indices for the rows to be added. set to None to use a range index
         """
 
+        #rows with a range index and rows with given indices cannot be concatenated together, so flush the buffered rows when switching between them
+        ignore_index = indices is None
+
+        if len(self._pending_rows) > 0 and ignore_index != self._pending_ignore_index:
+            self.flush()
+
+        self._pending_ignore_index = ignore_index
+        self._pending_rows.extend(rows)
+
+        if indices is not None:
+            self._pending_indices.extend(indices)
+
+    def flush(self):
+        """
+        concatenate the rows buffered by add_rows to the data frame
+        """
+
+        if len(self._pending_rows) == 0:
+            return
+
         #if this instance is initialized with no columns and no file is loaded, then self.df will have no columns, so set columns to None when creating df_new
         if len(self.df.columns) == 0:
             columns = None
         else:
             columns = self.df.columns
 
-        if indices is None:
-            df_new = pd.DataFrame(rows, columns = columns)
-            self.df = self.df.append(df_new, ignore_index = True)
+        if self._pending_ignore_index:
+            df_new = pd.DataFrame(self._pending_rows, columns = columns)
         else:
-            df_new = pd.DataFrame(rows, columns = columns, index = indices)
-            self.df = self.df.append(df_new)
+            df_new = pd.DataFrame(self._pending_rows, columns = columns, index = self._pending_indices)
+
+        self.df = pd.concat([self.df, df_new], ignore_index = self._pending_ignore_index, copy = False)
+
+        self._clear_pending_rows()
+
+    def _clear_pending_rows(self):
+        """
+        discard the rows buffered by add_rows
+        """
+
+        self._pending_rows = []
+        self._pending_indices = []
+        self._pending_ignore_index = True
 
     def update_rows(self, condition_column, condition, condition_value, columns_to_update, update_value):
         """
@@ -170,21 +294,12 @@ class DataStorage:
         update_value: value to be written in columns_to_update
         """
 
-        #array of True where the row meet the required condition in the required column and False otherwise
-        if condition == "gt":
-            bool_filter = self.df[condition_column] > condition_value
-        elif condition == "lt":
-            bool_filter = self.df[condition_column] < condition_value
-        elif condition == "eq":
-            if condition_value is not None:
-                bool_filter = self.df[condition_column] == condition_value
-            else:
-                bool_filter = self.df[condition_column].isnull()
-        elif condition == "neq":
-            if condition_value is not None:
-                bool_filter = self.df[condition_column] != condition_value
-            else:
-                bool_filter = self.df[condition_column].notnull()
+        self.flush()
+
+        bool_filter = self._build_mask(condition_column, condition, condition_value)
+
+        if bool_filter is None:
+            return
 
         self.df.loc[bool_filter, columns_to_update] = update_value
 
@@ -200,22 +315,11 @@ class DataStorage:
         return: data frame with rows that meet the required condition in the required column
         """
 
-        #array of True where the row meet the required condition in the required column and False otherwise
-        if condition == "gt":
-            bool_filter = self.df[column] > value
-        elif condition == "lt":
-            bool_filter = self.df[column] < value
-        elif condition == "eq":
-            if value is not None:
-                bool_filter = self.df[column] == value
-            else:
-                bool_filter = self.df[column].isnull()
-        elif condition == "neq":
-            if value is not None:
-                bool_filter = self.df[column] != value
-            else:
-                bool_filter = self.df[column].notnull()
-        else:
+        self.flush()
+
+        bool_filter = self._build_mask(column, condition, value)
+
+        if bool_filter is None:
             return
 
         return self.df[bool_filter]
@@ -229,25 +333,45 @@ class DataStorage:
         value: required value to filter rows by
         """
 
-        #array of True where the row meet the required condition in the required column and False otherwise
-        if condition == "gt":
-            bool_filter = self.df[column] > value
-        elif condition == "lt":
-            bool_filter = self.df[column] < value
-        elif condition == "eq":
-            if value is not None:
-                bool_filter = self.df[column] == value
-            else:
-                bool_filter = self.df[column].isnull()
-        elif condition == "neq":
-            if value is not None:
-                bool_filter = self.df[column] != value
-            else:
-                bool_filter = self.df[column].notnull()
-        else:
+        self.flush()
+
+        bool_filter = self._build_mask(column, condition, value)
+
+        if bool_filter is None:
             return
 
-        self.df = self.df.drop(self.df[bool_filter].index)
+        #keep the rows that do not meet the condition by position (avoids building a sub-dataframe and dropping its labels one by one)
+        self.df = self.df.take(np.flatnonzero(~bool_filter))
+
+    def _build_mask(self, column, condition, value):
+        """
+        build a boolean mask of the rows where a certain column's value is greater than, less than, or equal to the given value
+        numeric columns are compared on their numpy array to avoid the overhead of pandas series operations
+
+        column: column to search for the value inside
+        condition: comparison operator (gt: greater than, lt: less than, eq: equal to, neq: not equal to)
+        value: required value to filter rows by. if None, eq and neq check for missing and non-missing values, respectively
+
+        return: numpy array of True where the row meet the required condition in the required column and False otherwise. None if condition is unknown
+        """
+
+        if condition not in DataStorage._OPS:
+            return None
+
+        series = self.df[column]
+
+        if value is None and condition in ("eq", "neq"):
+            bool_filter = series.isnull().to_numpy()
+            return bool_filter if condition == "eq" else ~bool_filter
+
+        #numpy comparisons are only used for numeric (or boolean) numpy columns compared with a number
+        if isinstance(series.dtype, np.dtype) and (pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype)) and pd.api.types.is_number(value):
+            return DataStorage._OPS[condition](series.to_numpy(copy = False), value)
+
+        #other columns (dates, strings, nullable types) are compared by pandas, which converts the value to the column type (e.g. date strings to dates) and handles missing values
+        #missing values of nullable columns do not meet any condition
+        bool_filter = DataStorage._SERIES_OPS[condition](series, value)
+        return bool_filter.fillna(False).to_numpy(dtype = bool)
 
 
     @staticmethod
@@ -255,22 +379,42 @@ class DataStorage:
         """
         sort data storage by dates index in a reverse order (newest data first)
         columns are also sorted by name
+        the index is kept as a datetime index and is saved with date_format
 
         ds: data storage to sort
+        date_format: format of the dates index
         """
 
-        #convert index to datetime index
-        ds.df.index = pd.to_datetime(ds.df.index, format = date_format)
+        ds.flush()
+
+        #convert index to datetime index (if it is not already converted)
+        if not isinstance(ds.df.index, pd.DatetimeIndex):
+            ds.df.index = DataStorage._parse_dates(ds.df.index, date_format)
+
+        ds._date_format = date_format
 
         #sort by index
         ds.df.sort_index(ascending = False, inplace = True)
 
-        #convert index back to strings
-        ds.df.index = ds.df.index.strftime(date_format)
-
         #sort columns
         ds.df = ds.df.reindex(sorted(ds.df.columns), axis = 1)
 
+    @staticmethod
+    def _parse_dates(dates, date_format):
+        """
+        parse date strings to datetimes
+
+        dates: index of date strings
+        date_format: expected format of the dates
+        return: datetime index
+        """
+
+        try:
+            return pd.to_datetime(dates, format = date_format, cache = True)
+        except ValueError:
+            #stored dates may not follow date_format exactly (e.g. date-time strings in a file of dates, written by older versions). parse them as ISO 8601 dates in this case
+            return pd.to_datetime(dates, format = "ISO8601", cache = True)
+
     @staticmethod
     def intersect_on_column(dataframes, column_name):
         """
@@ -285,19 +429,14 @@ class DataStorage:
         return: list of pandas dataframe with the intersected rows on the given column_name
         """
 
-        #find the intersected dataframe
-        intersection_df = pd.merge_ordered(dataframes[0], dataframes[1], how = "inner", on = column_name)
-
-        for i in range(2, len(dataframes)):
-            intersection_df = pd.merge_ordered(intersection_df, dataframes[i], how = "inner", on = column_name)
-
-            #remove all columns - except the column being merged on - to improve performance of sub-sequent merge operations
-            #without this, performance degrades after each merge as each merge adds extra columns
-            columns_to_remove = intersection_df.columns.to_list()
-            columns_to_remove.remove(column_name)
-            intersection_df.drop(columns = columns_to_remove, inplace = True)
+        #find the values of column_name that are common to all dataframes (intersecting the column values only, without merging the whole dataframes)
+        #values are intersected as hashed indices (no sorting), so columns with mixed types or missing values can be intersected. missing values are not common values
+        column_values = [pd.Index(df[column_name]).dropna().unique() for df in dataframes]
+        common_values = functools.reduce(lambda x, y: x.intersection(y, sort = False), column_values)
 
-        #filter the given dataframes with the intersection_df column_name
-        intersection_dataframes = [df[df[column_name].isin(intersection_df[column_name])] for df in dataframes]
+        #filter the given dataframes with the common values
+        #the hashtable of common_values (unique values, as required by get_indexer) is built once on its first lookup and reused for all dataframes
+        #values not in common_values are located at -1. missing values are excluded explicitly so that they never match (same as isin)
+        intersection_dataframes = [df[(common_values.get_indexer(df[column_name]) >= 0) & df[column_name].notna().to_numpy()] for df in dataframes]
 
         return intersection_dataframes
@@ -1,16 +1,59 @@
-import math
+import numpy as np
 import os
 import pandas as pd
 import printcontrol as pc
 import re
 import requests
+import threading
 import time
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datastorage import DataStorage
 from dateoperations import DEFAULT_DATE_FORMAT, DEFAULT_DATETIME_FORMAT
+from requests.adapters import HTTPAdapter
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
 
+_sentiment_analyzer = None  #SentimentIntensityAnalyzer of the current process (created once per process by _init_sentiment_analyzer)
+
+def _init_sentiment_analyzer():
+    """
+    create the SentimentIntensityAnalyzer object of the current process
+    used as the initializer of the processes calculating news sentiments
+    """
+
+    global _sentiment_analyzer
+
+    _sentiment_analyzer = SentimentIntensityAnalyzer()
+
+def _text_sentiment(text):
+    """
+    calculate the sentiment of a text using VADER
+    defined at module level so that it can be sent to worker processes
+
+    text: text to analyze
+    return: tuple of sentiment (-1: negative, 0: neutral, 1: positive) and sentiment probability (range: [0:1])
+    """
+
+    if _sentiment_analyzer is None:
+        _init_sentiment_analyzer()
+
+    sentiment_dict = _sentiment_analyzer.polarity_scores(text)
+
+    negative = sentiment_dict['neg']
+    neutral = sentiment_dict['neu']
+    positive = sentiment_dict['pos']
+    compound = sentiment_dict['compound']
+
+    if compound >= 0.05:
+        return 1, positive
+    elif compound <= -0.05:
+        return -1, negative
+    else:
+        return 0, neutral
+
+
 class FMP:
     _SYMBOL_PLACEHOLDER = "###"
     _API_KEY_PLACEHOLDER = "@@@"
@@ -29,6 +72,27 @@ class FMP:
     #check https://financialmodelingprep.com/developer/docs/pricing
     CALL_DELAY = 60 / 300 #delay between api calls in seconds
 
+    _PAGE_WORKERS = 5   #number of pages requested in parallel
+
+    #http session shared by all api calls (connection pooling and keep-alive avoid a new connection for each page)
+    _SESSION = requests.Session()
+    _SESSION.mount("https://", HTTPAdapter(pool_connections = 1, pool_maxsize = _PAGE_WORKERS))
+
+    #pacing of the api calls
+    _call_lock = threading.Lock()
+    _next_call_time = 0   #earliest time (as returned by time.time()) of the next api call
+
+    #data types of the news storage sentiment columns (used to set the types of new news storages and of storages read from legacy csv files)
+    _NEWS_COLUMN_TYPES = {
+        "sentiment": "Int8", #nullable integer type (missing sentiments are NA)
+        "sentiment_probability": "float32"
+    }
+
+    #keys of the news read from the news api (publishedDate is used as the date index)
+    _NEWS_KEYS = ("title", "text", "site", "url", "symbol", "image")
+
+    _CAMEL_RE = re.compile(r'(?<!^)(?=[A-Z])')   #positions where an underscore is inserted when converting camelCase names to snake_case
+
 
     def __init__(self, symbol):
         #remove symbol extension
@@ -39,9 +103,9 @@ class FMP:
             
         self.symbol = symbol
 
-        #prepare data storages (index is date strings and columns are financial entry names)
-        self.news_ds = DataStorage(symbol, FMP._NEWS_DATA_DIR)                              #data storage with news
-        self.social_sentiment_ds = DataStorage(symbol, FMP._SOCIAL_SENTIMENT_DATA_DIR)      #data storage with social sentiments
+        #prepare data storages (index is dates and columns are financial entry names)
+        self.news_ds = DataStorage(symbol, FMP._NEWS_DATA_DIR, column_types = FMP._NEWS_COLUMN_TYPES, storage_format = "parquet")   #data storage with news
+        self.social_sentiment_ds = DataStorage(symbol, FMP._SOCIAL_SENTIMENT_DATA_DIR, storage_format = "parquet")                  #data storage with social sentiments
 
         self._load_data()
 
@@ -51,18 +115,19 @@ class FMP:
         """
 
         #load the data storages
-        #if a ds is not loaded, it means that this is the first time to use this ds, so add a date column and set it as index
-        if not self.news_ds.read_data(index_col = "date"):
-            self.news_ds.add_column("date")
-            self.news_ds.df.set_index("date", inplace = True)
+        #if a ds is not loaded, it means that this is the first time to use this ds, so set an empty dates index
+        if not self.news_ds.read_data(index_col = "date", date_format = DEFAULT_DATE_FORMAT):
+            self.news_ds.df.index = pd.DatetimeIndex([], name = "date")
 
             #add columns for sentiment
             self.news_ds.add_column("sentiment")                #-1: negative, 0: neutral, 1: positive
             self.news_ds.add_column("sentiment_probability")    #confidence in sentiment (range: [0:1])
 
-        if not self.social_sentiment_ds.read_data(index_col = "date"):
-            self.social_sentiment_ds.add_column("date")
-            self.social_sentiment_ds.df.set_index("date", inplace = True)
+            #set the types of the sentiment columns (the other columns are added when news are downloaded)
+            self.news_ds.df = self.news_ds.df.astype(FMP._NEWS_COLUMN_TYPES)
+
+        if not self.social_sentiment_ds.read_data(index_col = "date", date_format = DEFAULT_DATETIME_FORMAT):
+            self.social_sentiment_ds.df.index = pd.DatetimeIndex([], name = "date")
 
 
     def read_news(self, verbose = False):
@@ -94,56 +159,53 @@ class FMP:
         DataStorage.sort_ds_dates(self.news_ds, date_format = DEFAULT_DATE_FORMAT)
         self.news_ds.save_data(save_index = True)
 
-    def add_sentiment_to_news(self):
+    def add_sentiment_to_news(self, processes = None):
         """
         set sentiment parameters for the downloaded news rows
         sentiments are calculated using VADER
         references:
         - https://blog.quantinsti.com/vader-sentiment/
         - https://scribe.rip/m/global-identity?redirectUrl=https%3A%2F%2Ftowardsdatascience.com%2Fsentimental-analysis-using-vader-a3415fef7664
+
+        processes: number of processes used to calculate the sentiments in parallel (VADER is pure python and cpu-bound)
+            - if None, sentiments are calculated in the current process
+            - on platforms that start processes with spawn (Windows and macOS), the calling script must be guarded with if __name__ == "__main__":
         """
 
         if len(self.news_ds.df) == 0:
             return
 
-        #create SentimentIntensityAnalyzer object
-        sid = SentimentIntensityAnalyzer()
-
         #extract and update rows that have no sentiment
-        partial_df = self.news_ds.df[self.news_ds.df["sentiment"].isnull()]
-
-        for idx, row in partial_df.iterrows():
-            #obtain sentiment
-            #if the text is NaN, an exception will be thrown. try to analyze the title in this case
-            try:
-                sentiment_dict = sid.polarity_scores(row["text"])
-            except: 
-                try:
-                    sentiment_dict = sid.polarity_scores(row["title"])
-                except:
-                    self.news_ds.df.loc[idx, "sentiment"] = 0
-                    self.news_ds.df.loc[idx, "sentiment_probability"] = 0
+        missing_sentiment = self.news_ds.df["sentiment"].isnull().to_numpy()
+        partial_df = self.news_ds.df[missing_sentiment]
 
-                    continue
+        #analyze the text of each news (or its title if the text is missing)
+        texts = partial_df["text"].fillna(partial_df["title"])
+        has_text = texts.notnull().to_numpy()
+
+        #the same news are often repeated (across pages and symbols), so each unique text is analyzed once
+        unique_texts, unique_inverse = np.unique(texts[has_text].astype(str).to_numpy(), return_inverse = True)
+
+        if processes is not None and processes > 1:
+            with ProcessPoolExecutor(max_workers = processes, initializer = _init_sentiment_analyzer) as executor:
+                unique_results = list(executor.map(_text_sentiment, unique_texts, chunksize = 64))
+        else:
+            unique_results = [_text_sentiment(text) for text in unique_texts]
 
-            negative = sentiment_dict['neg']
-            neutral = sentiment_dict['neu']
-            positive = sentiment_dict['pos']
-            compound = sentiment_dict['compound']
-
-            if compound >= 0.05:
-                overall_sentiment = 1
-                sentiment_probability = positive
-            elif compound <= -0.05:
-                overall_sentiment = -1
-                sentiment_probability = negative
-            else:
-                overall_sentiment = 0
-                sentiment_probability = neutral
-
-            #add sentiment to df
-            self.news_ds.df.loc[idx, "sentiment"] = overall_sentiment
-            self.news_ds.df.loc[idx, "sentiment_probability"] = sentiment_probability
+        unique_sentiments = np.array([result[0] for result in unique_results], dtype = np.int8)
+        unique_sentiment_probabilities = np.array([result[1] for result in unique_results], dtype = np.float32)
+
+        #sentiments are collected in arrays and written to the df in one assignment per column
+        #news with no text and no title are left with a sentiment and a sentiment_probability of 0
+        sentiments = np.zeros(len(partial_df), dtype = np.int8)
+        sentiment_probabilities = np.zeros(len(partial_df), dtype = np.float32)
+
+        sentiments[has_text] = unique_sentiments[unique_inverse]
+        sentiment_probabilities[has_text] = unique_sentiment_probabilities[unique_inverse]
+
+        #add sentiment to df
+        self.news_ds.df.loc[missing_sentiment, "sentiment"] = sentiments
+        self.news_ds.df.loc[missing_sentiment, "sentiment_probability"] = sentiment_probabilities
 
         #save the dataset
         self.news_ds.save_data(save_index = True)
@@ -156,30 +218,14 @@ class FMP:
         return: pandas series with date index (sorted from earlier to newer) and aggregated sentiment as values
         """
 
-        def aggregate_sample_sentiment(sample):
-            """
-            calculate the aggregate sentiment for a given sample
-            the aggregation is the sum of the sentiment * sentiment_probability for each row in the sample
-
-            sample: values dataframe with "sentiment" and "sentiment_probability" columns to calculate the aggregation for
-            return: float|sample sentiment aggregation
-            """
-
-            if len(sample) == 0:
-                return 0
-
-            sample_aggregation = (sample["sentiment"] * sample["sentiment_probability"]).sum()
-            return sample_aggregation
-
-        #convert index of original dataframe to datetime index to allow date range masking
-        self.news_ds.df.index = pd.to_datetime(self.news_ds.df.index, format = DEFAULT_DATETIME_FORMAT)
+        #the aggregation of each period is the sum of the sentiment * sentiment_probability of its rows
+        #the index of the news dataframe is a datetime index, which allows resampling by date ranges
+        sentiment = self.news_ds.df["sentiment"].astype("float32")
+        sentiment_probability = self.news_ds.df["sentiment_probability"].astype("float32")
 
-        aggregatation = self.news_ds.df.groupby(pd.Grouper(freq = freq)).apply(aggregate_sample_sentiment)
+        aggregation = (sentiment * sentiment_probability).resample(freq).sum()
 
-        #convert index to strings
-        self.news_ds.df.index = self.news_ds.df.index.strftime(DEFAULT_DATETIME_FORMAT)
-
-        return aggregatation
+        return aggregation
 
 
     def read_social_sentiment(self, verbose = False):
@@ -246,48 +292,65 @@ class FMP:
 
 
         #news are spread of multiple pages. read them accordingly
-        curr_page = -1
+        #pages are requested ahead (in parallel) while the read pages are checked. calls are paced by FMP.CALL_DELAY before requesting each page
+        #with a cross-check, reading usually stops at the first pages, so pages are requested one at a time to avoid unused api calls
         response_list = []
 
         if verbose: pc_base_line = pc.last_line
 
-        while True:
-            loop_start_time = time.time()
+        page_url = lambda page: url.replace(FMP._PAGE_PLACEHOLDER, str(page))
+        max_pending_pages = 1 if cross_check is not None else FMP._PAGE_WORKERS
 
-            curr_page += 1
-            curr_url = url.replace(FMP._PAGE_PLACEHOLDER, str(curr_page))
+        pending_pages = deque()
+        next_page = 0
+        curr_page = 0
+        call_reserved = False
+        stop_reading = False
 
-            if verbose: pc.reprint(pc_base_line + " >> Reading page {}...".format(curr_page + 1))
-            
-            response = requests.get(curr_url)
-            curr_response_list = response.json() #list of dictionariess
+        with ThreadPoolExecutor(max_workers = FMP._PAGE_WORKERS) as executor:
+            while True:
+                #check the read pages in order. if the maximum number of pages is being read, wait for the oldest one
+                while len(pending_pages) > 0 and (pending_pages[0].done() or len(pending_pages) >= max_pending_pages):
+                    if verbose: pc.reprint(pc_base_line + " >> Reading page {}...".format(curr_page + 1))
+
+                    response = pending_pages.popleft().result()
+                    curr_response_list = response.json() #list of dictionariess (parsed once and reused below)
+                    curr_page += 1
+
+                    if len(curr_response_list) == 0:
+                        stop_reading = True
+                        break
 
-            if len(curr_response_list) == 0:
-                break
+                    response_list.extend(curr_response_list)
 
-            response_list += response.json()
+                    #if the latest entry in the current page is available in the cross-check series, there is no need to read the next pages as they are already available
+                    if cross_check is not None and (cross_check["series"].eq(response_list[-1][cross_check["dict_key"]])).any():
+                        stop_reading = True
+                        break
 
-            #if the latest entry in the current page is available in the cross-check series, there is no need to read the next pages as they are already available
-            if cross_check is not None and (cross_check["series"].eq(response_list[-1][cross_check["dict_key"]])).any():
-                break
+                #pages that are still being read when reading stops are waited for when the executor shuts down
+                if stop_reading:
+                    break
 
-            #delay after each call (except for the last call)
-            loop_end_time = time.time()
-            loop_total_time = loop_end_time - loop_start_time
-            loop_delay = FMP.CALL_DELAY - loop_total_time #subtract time that is already consumed by the loop from the required delay
+                #wait for the api limit before requesting the next page. pages read while waiting are checked first as they may stop the reading
+                if not call_reserved:
+                    FMP._wait_for_call()
+                    call_reserved = True
+                    continue
 
-            if loop_delay > 0:
-                time.sleep(loop_delay)
+                pending_pages.append(executor.submit(FMP._SESSION.get, page_url(next_page), timeout = 30))
+                next_page += 1
+                call_reserved = False
 
         if len(response_list) == 0:
             raise ValueError("Could not obtain data. Symbol may not be available.")
 
         #convert response to pandas dataframe
-        response_df = pd.json_normalize(response_list)
-
-        #rename date column from the news endpoint to follow project standards (fmp name is publishedDate)
+        #news have a known set of keys, so their dataframe is built directly without the schema inference of json_normalize
         if is_news:
-            response_df.rename(columns = {"publishedDate": "date"}, inplace = True)
+            return FMP._build_news_df(response_list)
+
+        response_df = pd.json_normalize(response_list)
 
         #Note: it is not required to update the date format of fmp as it already matches the required date format of DEFAULT_DATE_FORMAT
         #DEFAULT_DATE_FORMAT or DEFAULT_DATETIME_FORMAT (from common.dateoperations) are used for financials or news, respectively.
@@ -299,11 +362,47 @@ class FMP:
             raise KeyError("Incorrect data format obtained (No \"date\" column). First row: {}".format(response_df.iloc[0, :].values))
 
         #convert column names from camelCase to snake_case (lower-case underscore-separated words)
-        camel_case_to_snake_case = lambda name: re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+        camel_case_to_snake_case = lambda name: FMP._CAMEL_RE.sub('_', name).lower()
         response_df.rename(columns = camel_case_to_snake_case, inplace = True)
 
         return response_df
 
+    @staticmethod
+    def _build_news_df(response_list):
+        """
+        convert news read from the news api to a dataframe
+
+        response_list: list of news dictionaries
+        return: pandas dataframe of news keys as columns and date strings as indices
+        """
+
+        #rename date column from the news endpoint to follow project standards (fmp name is publishedDate)
+        try:
+            index = pd.Index([entry["publishedDate"] for entry in response_list], name = "date")
+        except KeyError:
+            raise KeyError("Incorrect data format obtained (No \"date\" column). First row: {}".format(list(response_list[0].values())))
+
+        columns = {key: np.array([entry.get(key) for entry in response_list], dtype = object) for key in FMP._NEWS_KEYS}
+
+        return pd.DataFrame(columns, index = index)
+
+    @staticmethod
+    def _wait_for_call():
+        """
+        wait until the next api call is allowed
+        calls (from all threads) are kept at least FMP.CALL_DELAY seconds apart to respect the api limit
+        """
+
+        #reserve the next available call time
+        with FMP._call_lock:
+            call_time = max(time.time(), FMP._next_call_time)
+            FMP._next_call_time = call_time + FMP.CALL_DELAY
+
+        delay = call_time - time.time()
+
+        if delay > 0:
+            time.sleep(delay)
+
     @staticmethod
     def _add_entries_to_ds(ds, entries):
         """
@@ -313,16 +412,17 @@ class FMP:
         entries: dataframe of new entries to add to the given ds
         """
 
-        #find rows and columns in entries that are not in ds
-        missing_rows = list(set(entries.index.tolist()) - set(ds.df.index.tolist()))
-        missing_columns = list(set(entries.columns) - set(ds.df.columns))
+        #entries have date strings as indices. convert them if the ds index is already a datetime index
+        if isinstance(ds.df.index, pd.DatetimeIndex):
+            entries.index = pd.to_datetime(entries.index, cache = True)
 
-        #add missing rows and columns to ds
-        for row in missing_rows:
-            ds.df.loc[row, :] = math.nan
+        #find rows and columns in entries that are not in ds
+        missing_rows = entries.index.difference(ds.df.index, sort = False)
+        missing_columns = entries.columns.difference(ds.df.columns, sort = False)
 
-        for column in missing_columns:
-            ds.df.loc[:, column] = math.nan
+        #add missing rows and columns to ds (added cells are set to NaN). ds is not reindexed if nothing is missing
+        if len(missing_rows) > 0 or len(missing_columns) > 0:
+            ds.df = ds.df.reindex(index = ds.df.index.append(missing_rows), columns = ds.df.columns.append(missing_columns))
 
         #update ds
         ds.df.update(entries)
@@ -2,12 +2,18 @@
 this module is used for printing operations
 """
 
+import os
+
 from sys import stdout
 
 
 _last_line_length = 0
 last_line = ""
 
+#terminals that support ANSI escape sequences can clear the line with a single sequence instead of printing spaces over it
+#output redirected to a file or a pipe is not a terminal, so it keeps the plain text spaces
+_ANSI_SUPPORTED = stdout.isatty() and os.environ.get("TERM", "dumb") != "dumb"
+
 def reprint(text):
     """
     prints a text on the same line
@@ -17,11 +23,14 @@ def reprint(text):
     global  _last_line_length, last_line
 
     #clear line
-    stdout.write('\r')
-    stdout.write("".join([" "] * _last_line_length)) #print spaces to cover the last text printed before
-
-    #return to start
-    stdout.write('\r')
+    if _ANSI_SUPPORTED:
+        stdout.write('\r\x1b[2K')
+    else:
+        stdout.write('\r')
+        stdout.write(" " * _last_line_length) #print spaces to cover the last text printed before
+
+        #return to start
+        stdout.write('\r')
 
     #write updated line
     stdout.write(text)